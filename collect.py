@@ -15,6 +15,7 @@ import db
 import argparse
 import bs4
 import datetime
+import glob
 import json
 import logging
 import os
@@ -38,6 +39,13 @@ VOTE_PAGING_FORM_URL = 'https://sfgov.legistar.com/DepartmentDetail.aspx?ID=7374
 VOTING_GRID_ID = 'ctl00_ContentPlaceHolder1_gridVoting_ctl00'
 # drop-down voting-year-selector
 YEAR_SELECTOR_ID = 'ctl00_ContentPlaceHolder1_lstTimePeriodVoting_DropDown'
+# postback target for commands fired at the voting grid, and the argument
+# telling it which table view the command is for.
+VOTING_GRID_TARGET = 'ctl00$ContentPlaceHolder1$gridVoting'
+VOTING_GRID_TABLE_VIEW = 'ctl00$ContentPlaceHolder1$gridVoting$ctl00'
+# page sizes to ask the voting grid for, largest first.  fewer, larger pages
+# mean fewer of the (slow, VIEWSTATE laden) round trips to legistar.
+VOTING_GRID_PAGE_SIZES = [1000, 500, 250, 100]
 
 class LegistarNavigator(object):
   """"Helper class to fetch/post data to legistar."""
@@ -61,7 +69,7 @@ class LegistarNavigator(object):
     Returns:
       bs4.BeautifulSoup of the fetched page.
     """
-    cache_file = '%s/%s.html' % (self._cache_dir, name)
+    cache_file = self._cache_file(name)
     logging.info("%s -> %s" % (url, cache_file))
     if not os.path.exists(cache_file):
       tmp_file = tempfile.NamedTemporaryFile(delete=False)
@@ -83,6 +91,31 @@ class LegistarNavigator(object):
 
     return soup
 
+  def forget(self, name):
+    """Remove a page from the cache dir, so it's fetched again next time."""
+    cache_file = self._cache_file(name)
+    if os.path.exists(cache_file):
+      os.remove(cache_file)
+
+  def remember(self, name):
+    """Leave an empty marker file in the cache dir."""
+    file(self._cache_file(name), 'w').close()
+
+  def is_cached(self, name):
+    return os.path.exists(self._cache_file(name))
+
+  def save_state(self):
+    """Returns the cookie and form state, for use with restore_state."""
+    return (self.cookie, dict(self._asp_attrs))
+
+  def restore_state(self, state):
+    """Rewinds the cookie and form state to what save_state returned."""
+    (self.cookie, asp_attrs) = state
+    self._asp_attrs = dict(asp_attrs)
+
+  def _cache_file(self, name):
+    return '%s/%s.html' % (self._cache_dir, name)
+
 
 class VotingInterfaceInfo(object):
   """An awkward but whatever helper class for parsing state of the form.
@@ -99,6 +132,9 @@ class VotingInterfaceInfo(object):
       be passed as the __EVENTTARGET in the POST, when paginating to the
       next page number.
     next_page_arg, string, same, but for __EVENTARGUMENT.
+    page_size, int, the number of rows per page according to the pager's
+      page size control, or None if it couldn't be found.
+    row_count, int, the number of rows on the current page.
     year_dropdown_indicies, dict, string -> int mappings where the key
       is a year found in the "select voting period" dropdown filter, and the
       value is the index in the dropdown field, which is needed in the
@@ -111,6 +147,8 @@ class VotingInterfaceInfo(object):
     self.next_page = None
     self.next_page_target = None
     self.next_page_arg = None
+    self.page_size = None
+    self.row_count = 0
     self.year_dropdown_indices = {}
 
     # parse the year dropdown
@@ -121,6 +159,14 @@ class VotingInterfaceInfo(object):
 
     # find the paginated results heading for the vote table
     table = soup.find(id=VOTING_GRID_ID)
+    self.row_count = len(table.find_all(class_='rgRow'))
+    page_size_input = table.select('thead > tr.rgPager input[id$=PageSizeComboBox_Input]')
+    if page_size_input:
+      try:
+        self.page_size = int(page_size_input[0]['value'])
+      except (KeyError, ValueError):
+        pass
+
     page_elements = table.select('thead > tr.rgPager > td > table > tbody > tr > td > div > a.rgCurrentPage')
 
     if len(page_elements):
@@ -185,14 +231,14 @@ def scrape_proposal_page(proposal_url, file_number):
           db.get_or_create(db.session, db.NounPhrase, phrase=blob_phrase))
     
     db.session.add(db_proposal) 
-    db.session.commit()
+    db.session.flush()
     return db_proposal
 
 
 def scrape_vote_page(soup):
     """
     Assuming the browser is on a page containing a grid of votes, scrapes
-    the vote data to populate the database.
+    the vote data to populate the database.  The caller commits.
     """
     # Get the contents of the table
     headers, rows = extract_grid_cells(soup, VOTING_GRID_ID)
@@ -211,44 +257,153 @@ def scrape_vote_page(soup):
     legislator_objects = {}
 
     # Pull values from each row and use them to populate the database
+    for row in rows: 
+        file_number = int(extract_text(row['File #']))
+        action_date = parse_date(extract_text(row['Action Date']))
+
+        # Find the proposal in the DB, or, if it isn't there,
+        # create a record for it by scraping the info page about that 
+        # proposal.
+        db_proposal = find_proposal(file_number) or (
+            scrape_proposal_page(row['File #'].a['href'], file_number))
+        if not db_proposal:
+          continue
+
+        db_vote_event = db.VoteEvent(db_proposal, action_date)
+        db.session.add(db_vote_event)
+        db.session.flush()
+
+        for name in supervisors:
+            vote_cast = extract_text(row[name])
+            if vote_cast in ('Aye', 'No'):
+                db.session.add(db.Vote(
+                    record_supervisor(name),
+                    db_vote_event,
+                    vote_cast == 'Aye'
+                ))
+    db.session.flush()
+
+
+def select_page_size(fetcher, year, soup):
+  """
+  Asks the voting grid to show as many rows per page as it will allow.
+
+  Given the first page of a year's votes (with the default page size),
+  this fires "PageSize" commands at the grid, trying the sizes in
+  VOTING_GRID_PAGE_SIZES in order.  If legistar doesn't go along with any
+  of them, the navigator's form state is restored so the normal pager can
+  be used instead.  Sizes which legistar turned down are remembered in the
+  cache, so they aren't tried again until the year's listings are.
+
+  Returns:
+    (soup, page_size) for the first page of results to continue from,
+    where page_size is None if the default page size is being used.
+  """
+  default_info = VotingInterfaceInfo(soup)
+  if default_info.next_page == None:
+    # everything already fits on one page.
+    return (soup, None)
+
+  state = fetcher.save_state()
+
+  def reject(cache_name):
+    # swap the rejection page for a marker, and put the form state back the
+    # way it was for the default pager.
+    fetcher.forget(cache_name)
+    fetcher.remember('%s-rejected' % cache_name)
+    fetcher.restore_state(state)
+
+  for page_size in VOTING_GRID_PAGE_SIZES:
+    if default_info.page_size and page_size <= default_info.page_size:
+      break
+    cache_name = 'vote-listings-%s-pagesize-%d-page-1' % (year, page_size)
+    if fetcher.is_cached('%s-rejected' % cache_name):
+      continue
+    payload = json.load(file('payload-page-select.json'))
+    payload['__EVENTTARGET'] = VOTING_GRID_TARGET
+    payload['__EVENTARGUMENT'] = 'FireCommand:%s;PageSize;%d' % (
+        VOTING_GRID_TABLE_VIEW, page_size)
     try:
-        for row in rows: 
-            file_number = int(extract_text(row['File #']))
-            action_date = parse_date(extract_text(row['Action Date']))
-
-            # Find the proposal in the DB, or, if it isn't there,
-            # create a record for it by scraping the info page about that 
-            # proposal.
-            db_proposal = find_proposal(file_number) or (
-                scrape_proposal_page(row['File #'].a['href'], file_number))
-            if not db_proposal:
-              continue
-
-            db_vote_event = db.VoteEvent(db_proposal, action_date)
-            db.session.add(db_vote_event)
-            db.session.flush()
-            db.session.commit()
-
-            for name in supervisors:
-                vote_cast = extract_text(row[name])
-                if vote_cast in ('Aye', 'No'):
-                    db.session.add(db.Vote(
-                        record_supervisor(name),
-                        db_proposal,
-                        vote_cast == 'Aye'
-                    ))
-    finally:
-      db.session.flush()
-      db.session.commit()
+      sized_soup = fetcher.fetch(
+          VOTE_PAGING_FORM_URL, cache_name, payload=payload)
+    except requests.RequestException as e:
+      # probably transient, so don't hold it against this page size.
+      logging.warn('Page size %d failed for %s: %s' % (page_size, year, e))
+      fetcher.restore_state(state)
+      break
+    try:
+      info = VotingInterfaceInfo(sized_soup)
+    except Exception as e:
+      logging.warn('Page size %d rejected for %s: %s' % (page_size, year, e))
+      reject(cache_name)
+      continue
+
+    if info.page_size == page_size or info.row_count > default_info.row_count:
+      logging.info('Using page size %d for %s' % (page_size, year))
+      return (sized_soup, page_size)
+    logging.warn('Page size %d ignored for %s' % (page_size, year))
+    reject(cache_name)
+
+  return (soup, None)
+
+
+def forget_vote_year(year):
+  """
+  Drops the recorded vote events (and votes) for a year, so that the year
+  can be scraped again without duplicating them.  Proposals are kept, since
+  they're shared between years.  Doesn't commit, so that the old votes can
+  be swapped for the new ones in one transaction.
+  """
+  year_events = db.session.query(db.VoteEvent).filter(
+      db.VoteEvent.vote_date.between(
+          datetime.date(year, 1, 1), datetime.date(year, 12, 31)))
+  (db.session.query(db.Vote)
+      .filter(db.Vote.vote_event_id.in_(
+          year_events.with_entities(db.VoteEvent.id).subquery()))
+      .delete(synchronize_session=False))
+  year_events.delete(synchronize_session=False)
+
+
+def forget_orphaned_votes():
+  """
+  Drops votes which aren't linked to any vote event.  Older versions of
+  this script never linked votes to their vote events, so those votes
+  can't be told apart; the years they came from need scraping again.
+  """
+  count = (db.session.query(db.Vote)
+      .filter(db.Vote.vote_event_id == None)
+      .delete(synchronize_session=False))
+  db.session.commit()
+  if count:
+    logging.warn('Dropped %d votes without a vote event, re-run collect.py '
+                 'for previously scraped years to restore them' % count)
+
+
+def forget_cached_listings(year):
+  """
+  Drops the cached vote listings for a year, so they're fetched again from
+  legistar.  The cached front page and votes tab go too, since replaying
+  their stale VIEWSTATE (without a session cookie) won't get fresh results.
+  """
+  cache_files = glob.glob('./cache/vote-listings-%s-*.html' % (year,))
+  cache_files += ['./cache/frontpage.html', './cache/votes-selected.html']
+  for cache_file in cache_files:
+    if os.path.exists(cache_file):
+      os.remove(cache_file)
 
 
 def scrape_vote_years(year_range):
   """
   Opens the votes page and scrapes the votes for all years in the given range.
-  Populates the database and commits the transaction
+  Populates the database and commits the transaction.  Votes previously
+  recorded for a year are replaced once that year has been scraped
+  successfully.
   """
+  forget_orphaned_votes()
   for year in year_range:
     try:
+      forget_vote_year(year)
+
       # OK, so first we go to the frontpage and navigate our way to the
       # voting results (this is necessary to get the wonderful snowflake
       # of an app that legistar is to register some necessary server-side state.
@@ -278,6 +433,14 @@ def scrape_vote_years(year_range):
           VOTE_PAGING_FORM_URL, 
           'vote-listings-%s-page-1' % (year,),
           payload=payload)
+
+      # Paginating is slow, so try to get the results in as few pages
+      # as possible.
+      soup, page_size = select_page_size(fetcher, year, soup)
+      if page_size:
+        cache_prefix = 'vote-listings-%s-pagesize-%d' % (year, page_size)
+      else:
+        cache_prefix = 'vote-listings-%s' % (year,)
       scrape_vote_page(soup)
 
       while True:
@@ -290,10 +453,11 @@ def scrape_vote_years(year_range):
         payload['__EVENTARGUMENT'] = pager_info.next_page_arg
         soup = fetcher.fetch(
             VOTE_PAGING_FORM_URL,
-            'vote-listings-%s-page-%s' % (year, pager_info.next_page),
+            '%s-page-%s' % (cache_prefix, pager_info.next_page),
             payload=payload)
         scrape_vote_page(soup)
 
+      db.session.commit()
     except:
       db.session.rollback()
       raise
@@ -380,5 +544,12 @@ if __name__ == '__main__':
   )
   parser.add_argument('first_year', metavar='first year', type=int)
   parser.add_argument('last_year', metavar='last year', type=int)
+  parser.add_argument('--refresh', action='store_true', help=
+      'fetch the vote listings for these years again, rather than using '
+      'the cached copies')
   args = parser.parse_args()
-  scrape_vote_years(range(args.first_year, args.last_year + 1))
+  year_range = range(args.first_year, args.last_year + 1)
+  if args.refresh:
+    for year in year_range:
+      forget_cached_listings(year)
+  scrape_vote_years(year_range)
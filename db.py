@@ -7,7 +7,7 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.types import Integer, String, Date, Boolean
 from sqlalchemy.schema import Column, ForeignKey
 from sqlalchemy.orm import sessionmaker, relationship
-from sqlalchemy import create_engine, Table
+from sqlalchemy import create_engine, func, Table
 
 CONNECTION_STRING = 'sqlite:///vote_db.sqlite'
 
@@ -34,7 +34,7 @@ class Proposal(Base):
     __tablename__ = 'proposals'
     id = Column(Integer, primary_key=True)
     title = Column(String)
-    file_number = Column(Integer)
+    file_number = Column(Integer, index=True)
     status = Column(String(255))
     introduction_date = Column(Date)
     proposal_type = Column(String(255))
@@ -84,11 +84,32 @@ class Vote(Base):
     vote_event_id = Column(Integer, ForeignKey('vote_events.id'), primary_key=True, nullable=True)
     aye_vote = Column(Boolean)
 
-    def __init__(self, legislator, proposal, aye):
+    def __init__(self, legislator, vote_event, aye):
         self.legislator = legislator
-        self.proposal = proposal
+        self.vote_event = vote_event
         self.aye_vote = aye
 
+class LobbyingReference(Base):
+  """A file number cited by a lobbyist contact record from DataSF.
+
+  Links a SODA record (by its :id) to a proposal (by its file number),
+  so that lobbying activity can be joined against the voting records.
+  The file number is deliberately not a foreign key, since lobbyists
+  can cite files that haven't been scraped (yet).
+  """
+  __tablename__ = 'lobbying_references'
+  soda_id = Column(String(64), primary_key=True)
+  file_number = Column(Integer, primary_key=True, index=True)
+  contact_date = Column(Date, index=True)
+  # the record's SODA :updated_at, to spot records changed since indexing.
+  updated_at = Column(String(32))
+
+  def __init__(self, soda_id, file_number, contact_date, updated_at=None):
+    self.soda_id = soda_id
+    self.file_number = file_number
+    self.contact_date = contact_date
+    self.updated_at = updated_at
+
 def get_or_create(session, model, **kwargs):
   """Helper routine to get/create instances of a model.
 
@@ -115,6 +136,49 @@ proposals_and_phrases = Table(
     Column('noun_phrase_id', Integer,
            ForeignKey("noun_phrases.id"), primary_key=True))
 
+def lobbying_for_legislator(session, legislator):
+  """Lobbying references for proposals that a legislator voted on.
+
+  Params:
+    session: sqlalchemy.orm.session, the session context to use.
+    legislator: Legislator, the supervisor of interest.
+
+  Returns:
+    A query of (LobbyingReference, Proposal) tuples.
+  """
+  return (session.query(LobbyingReference, Proposal)
+      .join(Proposal, Proposal.file_number == LobbyingReference.file_number)
+      .join(VoteEvent, VoteEvent.proposal_id == Proposal.id)
+      .join(Vote, Vote.vote_event_id == VoteEvent.id)
+      .filter(Vote.legislator_id == legislator.id)
+      .distinct())
+
+def lobbying_before_vote_events(session):
+  """Number of lobbying contacts on a proposal preceding each vote on it.
+
+  Params:
+    session: sqlalchemy.orm.session, the session context to use.
+
+  Returns:
+    A query of (VoteEvent, count) tuples.
+  """
+  return (session.query(VoteEvent, func.count(LobbyingReference.soda_id))
+      .join(Proposal, Proposal.id == VoteEvent.proposal_id)
+      .join(LobbyingReference,
+            LobbyingReference.file_number == Proposal.file_number)
+      .filter(LobbyingReference.contact_date <= VoteEvent.vote_date)
+      .group_by(VoteEvent.id))
+
+def migrate(engine):
+  """Bring a database created from an older schema up to date.
+
+  create_all only creates missing tables (and their indexes), so the index
+  on the pre-existing proposals table has to be added here.
+  """
+  engine.execute('CREATE INDEX IF NOT EXISTS ix_proposals_file_number '
+                 'ON proposals (file_number)')
+
 engine = create_engine(CONNECTION_STRING)
 Base.metadata.create_all(engine)
+migrate(engine)
 session = sessionmaker(bind=engine)()
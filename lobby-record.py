@@ -3,16 +3,22 @@
 import collections
 import datetime
 import dateutil.parser
+import hashlib
 import json
+import logging
 import os
+import re
 import sys
 import urllib
 import tempfile
 import time
 
-import collect
+import db
 import sfdata
 
+# number of record ids to delete from the reference index per statement.
+INDEX_BATCH_SIZE = 500
+
 class Timeline(object):
 
   def __init__(self, title):
@@ -43,28 +49,96 @@ def parse_date(date_string):
   """Extract a datetime.date object from a given string."""
   return dateutil.parser.parse(date_string).date()
 
-def timeline_report(_):
+def lobbyist_records():
+  """The local snapshot of lobbyist activity.
+
+  A snapshot fetched before records were keyed by their SODA :id can't be
+  linked to proposals, so it's fetched again rather than silently giving
+  empty timelines.
+  """
+  activity = sfdata.LobbyistActivity()
+  records = activity.records()
+  if any(':id' not in r for r in records):
+    logging.warn('%s has records without an :id, fetching it again' % (
+        activity.cache_file))
+    activity.fetch(refresh=True)
+    records = activity.records()
+  return records
+
+def index_lobbying_references(records):
+  """Store the file numbers cited by lobbyist records in the database.
+
+  Only records updated since the last indexing run (according to their
+  SODA :updated_at) are tokenized, so this is cheap to run on every
+  invocation.  If there's no such watermark, everything is re-indexed.
+  Records without a SODA :id (i.e. from a stale cache file) can't be
+  linked and are skipped.
+  """
+  references = db.session.query(db.LobbyingReference)
+  watermark = db.session.query(
+      db.func.max(db.LobbyingReference.updated_at)).scalar()
+  if not watermark:
+    changed = [r for r in records if r.get(':id')]
+    references.delete(synchronize_session=False)
+  else:
+    changed = [r for r in records if r.get(':id')
+               and r.get(':updated_at', '') >= watermark]
+    # in batches, to stay clear of sqlite's limit on bound parameters.
+    changed_ids = [r[':id'] for r in changed]
+    for i in range(0, len(changed_ids), INDEX_BATCH_SIZE):
+      (references
+          .filter(db.LobbyingReference.soda_id.in_(
+              changed_ids[i:i + INDEX_BATCH_SIZE]))
+          .delete(synchronize_session=False))
+  rows = []
+  for record in changed:
+    contact_date = parse_date(record['date'])
+    for file_number in set(file_numbers(record)):
+      rows.append({'soda_id': record[':id'],
+                   'file_number': file_number,
+                   'contact_date': contact_date,
+                   'updated_at': record.get(':updated_at')})
+  if rows:
+    db.session.execute(db.LobbyingReference.__table__.insert(), rows)
+  db.session.commit()
+  logging.info('indexed %d lobbying references from %d records' % (
+      len(rows), len(changed)))
+
+def records_between(records, since_when, until_when):
+  """The lobbyist records dated within the given window, inclusive."""
+  return [r for r in records
+          if parse_date(r['date']) >= since_when
+          and parse_date(r['date']) <= until_when]
+
+def proposal_timelines(records):
+  """Timelines of lobbying activity, keyed by proposal file number."""
+  records = dict((r[':id'], r) for r in records if ':id' in r)
   timelines = {}
-  for record in sfdata.LobbyistActivity().records():
-    for file_number in file_numbers(record):
-      proposal = collect.find_proposal(file_number)
-      if proposal:
-        if file_number not in timelines:
-          timeline = Timeline(proposal.title)
-          introduction_ts =  time.mktime(proposal.introduction_date.timetuple())
-          timeline.add_event(introduction_ts, 'introduced')
-          timelines[file_number] = timeline
-        else:
-          timeline = timelines[file_number]
-        ts = time.mktime(parse_date(record['date']).timetuple())
-        timeline.add_event(ts, record)
-
-  return [timelines[filenum].json() for filenum in sorted(timelines)] 
-
-def contacts_report(since_when, until_when):
-  records = [r for r in sfdata.LobbyistActivity().records()
-             if parse_date(r['date']) >= since_when
-             and parse_date(r['date']) <= until_when]
+  references = (db.session.query(db.LobbyingReference, db.Proposal)
+      .join(db.Proposal,
+            db.Proposal.file_number == db.LobbyingReference.file_number))
+  for reference, proposal in references:
+    record = records.get(reference.soda_id)
+    if not record:
+      continue
+    file_number = reference.file_number
+    if file_number not in timelines:
+      timeline = Timeline(proposal.title)
+      introduction_ts =  time.mktime(proposal.introduction_date.timetuple())
+      timeline.add_event(introduction_ts, 'introduced')
+      timelines[file_number] = timeline
+    else:
+      timeline = timelines[file_number]
+    ts = time.mktime(reference.contact_date.timetuple())
+    timeline.add_event(ts, record)
+  return timelines
+
+def contacts_report(records):
+  """Contact counts by department, official, firm and client.
+
+  Yields:
+    (department, CSV line) tuples.
+  """
   contacts = collections.defaultdict(
       lambda: collections.defaultdict(
           lambda: collections.defaultdict(
@@ -78,22 +152,28 @@ def contacts_report(since_when, until_when):
         for client in sorted(contacts[department][official][firm]):
           count = contacts[department][official][firm][client]
           key = '-'.join([department, official, firm, client]).encode('utf-8')
-          yield ('%s,%s' % (urllib.quote(key), count)).encode('utf-8')
+          yield (department,
+                 ('%s,%s' % (urllib.quote(key), count)).encode('utf-8'))
+
 
+def department_topics_report(records):
+  """Contact counts by department and topic, leaving out the rare ones.
 
-def department_topics_report(since_when, until_when):
+  Yields:
+    (department, CSV line) tuples.
+  """
   min_threshold = 4
 
-  records = [r for r in sfdata.LobbyistActivity().records()
-             if parse_date(r['date']) >= since_when
-             and parse_date(r['date']) <= until_when]
   by_topic = collections.defaultdict(lambda: collections.defaultdict(lambda: 0))
+  # cleaned -> original department names, to key the yielded lines by.
+  departments = {}
 
   def clean(str):
     return urllib.quote(str).replace('-', ' ').replace(',', ' ').encode('utf-8')
 
   for r in records:
     department = clean(r['official_department'])
+    departments.setdefault(department, r['official_department'])
     topic = clean(r['lobbyingsubjectarea'])
     by_topic[department][topic] += 1
 
@@ -102,7 +182,8 @@ def department_topics_report(since_when, until_when):
       count = by_topic[department][topic]
       key = '-'.join([department, topic])
       if count > min_threshold:
-        yield ('%s,%s' % (key, count)).encode('utf-8')
+        yield (departments[department],
+               ('%s,%s' % (key, count)).encode('utf-8'))
 
 
 def contact_mapping_report(since_when):
@@ -126,11 +207,96 @@ def contact_mapping_report(since_when):
 
   return {'mappings': reverse_mappings, 'matrix': matrix}
 
+def content_hash(data):
+  return hashlib.sha1(data).hexdigest()
+
+def shard_names(keys):
+  """File name friendly, unique versions of some shard keys.
+
+  Keys which would otherwise end up with the same (or an empty) name get a
+  short hash of the key appended.
+
+  Returns:
+    dict, shard key -> name.
+  """
+  names = {}
+  # 'index' is taken by the manifest.
+  used = set(['index'])
+  for key in sorted(keys):
+    name = re.sub(r'[^A-Za-z0-9]+', '-', key).strip('-').lower()
+    if not name or name in used:
+      name = '%s-%s' % (name or 'shard', content_hash(key.encode('utf-8'))[:8])
+    used.add(name)
+    names[key] = name
+  return names
+
+def by_department(rows):
+  """Group (department, line) tuples into one CSV blob per department."""
+  slices = collections.defaultdict(list)
+  for department, line in rows:
+    slices[department].append(line)
+  return dict((d, '\n'.join(lines)) for (d, lines) in slices.items())
+
 def write_report_as(filename, data):
-  tf = tempfile.NamedTemporaryFile(delete=False) 
+  """Write data to a file under data/, unless it already has that content.
+
+  Returns:
+    string, the content hash of data.
+  """
+  path = 'data/%s' % filename
+  digest = content_hash(data)
+  if os.path.exists(path) and content_hash(file(path).read()) == digest:
+    return digest
+  directory = os.path.dirname(path)
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+  tf = tempfile.NamedTemporaryFile(dir=directory, delete=False)
   tf.write(data)
   tf.close()
-  os.rename(tf.name, 'data/%s' % filename)
+  os.rename(tf.name, path)
+  return digest
+
+def write_sharded_report(name, extension, shards, titles=None):
+  """Write a report as one file per shard, plus an index.json manifest.
+
+  The manifest maps each shard key to the shard's path (relative to data/)
+  and a content hash, which frontends can use to fetch only the shards they
+  need, and to bust caches.  Shards whose content hasn't changed since the
+  last run aren't rewritten, and shards which no longer exist are removed.
+
+  Args:
+    name, string, the directory under data/ to write the shards to.
+    extension, string, the file extension of the shards.
+    shards, dict, shard key -> serialized shard contents.
+    titles, dict, optional shard key -> title to include in the manifest.
+  """
+  manifest_file = '%s/index.json' % name
+  try:
+    old_manifest = json.load(file('data/%s' % manifest_file))
+  except (IOError, ValueError):
+    old_manifest = {}
+
+  manifest = {}
+  names = shard_names(shards)
+  for key in sorted(shards):
+    path = '%s/%s.%s' % (name, names[key], extension)
+    digest = content_hash(shards[key])
+    old_entry = old_manifest.get(key, {})
+    if (old_entry.get('hash') != digest or old_entry.get('path') != path
+        or not os.path.exists('data/%s' % path)):
+      write_report_as(path, shards[key])
+    manifest[key] = {'path': path, 'hash': digest}
+    if titles:
+      manifest[key]['title'] = titles[key]
+
+  current = set(os.path.basename(e['path']) for e in manifest.values())
+  current.add(os.path.basename(manifest_file))
+  if os.path.isdir('data/%s' % name):
+    for filename in os.listdir('data/%s' % name):
+      if filename.endswith('.%s' % extension) and filename not in current:
+        os.remove('data/%s/%s' % (name, filename))
+
+  write_report_as(manifest_file, json.dumps(manifest, sort_keys=True, indent=1))
 
 if __name__ == '__main__':
   default_start = datetime.date.today() - datetime.timedelta(days=365)
@@ -144,12 +310,26 @@ if __name__ == '__main__':
   except:
     until_when = default_end
 
-  write_report_as('Timeline.json', json.dumps(timeline_report(since_when)))
+  logging.basicConfig(level='INFO')
+  records = lobbyist_records()
+  index_lobbying_references(records)
+  timelines = dict((filenum, timeline.json()) for (filenum, timeline)
+                   in proposal_timelines(records).items())
+  write_report_as('Timeline.json', json.dumps(
+      [timelines[filenum] for filenum in sorted(timelines)]))
+  write_sharded_report(
+      'Timeline', 'json',
+      dict((str(f), json.dumps(t)) for (f, t) in timelines.items()),
+      titles=dict((str(f), t['title']) for (f, t) in timelines.items()))
+
+  records = records_between(records, since_when, until_when)
+  contacts = list(contacts_report(records))
   write_report_as(
-      'FirmToDeptContacts.csv',
-      '\n'.join(contacts_report(since_when, until_when)))
+      'FirmToDeptContacts.csv', '\n'.join(line for (_, line) in contacts))
+  write_sharded_report('FirmToDeptContacts', 'csv', by_department(contacts))
 
+  topics = list(department_topics_report(records))
   write_report_as(
-      'ByDepartmentByTopic.csv',
-      '\n'.join(department_topics_report(since_when, until_when)))
+      'ByDepartmentByTopic.csv', '\n'.join(line for (_, line) in topics))
+  write_sharded_report('ByDepartmentByTopic', 'csv', by_department(topics))
 
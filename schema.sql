@@ -12,6 +12,7 @@ CREATE TABLE proposals (
 	proposal_type VARCHAR(255), 
 	PRIMARY KEY (id)
 );
+CREATE INDEX ix_proposals_file_number ON proposals (file_number);
 CREATE TABLE noun_phrases (
 	id INTEGER NOT NULL, 
 	phrase VARCHAR, 
@@ -40,3 +41,12 @@ CREATE TABLE votes (
 	FOREIGN KEY(vote_event_id) REFERENCES vote_events (id), 
 	CHECK (aye_vote IN (0, 1))
 );
+CREATE TABLE lobbying_references (
+	soda_id VARCHAR(64) NOT NULL, 
+	file_number INTEGER NOT NULL, 
+	contact_date DATE, 
+	updated_at VARCHAR(32), 
+	PRIMARY KEY (soda_id, file_number)
+);
+CREATE INDEX ix_lobbying_references_file_number ON lobbying_references (file_number);
+CREATE INDEX ix_lobbying_references_contact_date ON lobbying_references (contact_date);
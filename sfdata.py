@@ -1,5 +1,6 @@
 #! /usr/bin/python
 
+import collections
 import json
 import logging
 import os
@@ -22,40 +23,91 @@ class SodaEndPoint(object):
 
   limit = 50000
   order = ':id'
+  # system fields always requested alongside the data: :id so records can
+  # be referred to later, :updated_at so the snapshot can be refreshed.
+  system_columns = [':id', ':updated_at']
 
   def __init__(self):
     self._fetched = False
 
-  def fetch(self):
+  def query(self, where=None):
+    """Fetch records (and their system columns) from the SODA endpoint.
+
+    Args:
+      where, string, an optional SoQL $where clause, to filter server-side.
+
+    Returns:
+      list of dicts, the matching records, as returned by the endpoint.
+    """
+    select = ','.join(self.system_columns + ['*'])
     result = []
+    offset = 0
+    while True:
+      logging.info('fetching records %d - %d' % (offset, offset + self.limit - 1))
+      params = {'$select': select, '$order': self.order,
+                '$offset': offset, '$limit': self.limit}
+      if where:
+        params['$where'] = where
+      resp = requests.get(self.url, params=params)
+      logging.info('%s => %s' % (resp.url, resp.status_code))
+      resp.raise_for_status()
+      data = resp.json()
+      if data:
+        result.extend(data)
+        offset += self.limit
+      else:
+        break
+    return result
+
+  def fetch(self, refresh=False):
+    """Populate the local snapshot of the dataset.
+
+    Args:
+      refresh, bool, if the snapshot already exists, ask the endpoint for
+        records updated since the newest one in the snapshot and merge them
+        in.  Records updated in that same second are fetched again, since
+        :updated_at only has one second resolution.  Otherwise an existing
+        snapshot is used as-is.
+
+    Note that deleted records won't be noticed by a refresh; remove the
+    cache file to start over from scratch.
+    """
     if not os.path.exists(self.cache_file):
-      offset = 0
-      while True:
-        logging.info('fetching records %d - %d' % (offset, offset + self.limit - 1))
-        url = '%s?$order=%s&$offset=%d&$limit=%d' % (self.url, self.order, offset, self.limit)
-        resp = requests.get(url)
-        logging.info('%s => %s' % (url, resp.status_code))
-        resp.raise_for_status()
-        data = resp.json()
-        if data:
-          result.extend(resp.json())
-          offset += self.limit
-        else:
-          break
-      tmp_file = tempfile.NamedTemporaryFile(delete=False)
-      tmp_file.write(json.dumps(result, indent=1))
-      os.rename(tmp_file.name, self.cache_file)
+      self._write_snapshot(self.query())
+    elif refresh:
+      snapshot = json.load(file(self.cache_file))
+      last_update = max([r.get(':updated_at', '') for r in snapshot] or [''])
+      if not last_update:
+        logging.warn('%s has no :updated_at fields, fetching everything' % (
+            self.cache_file))
+        self._write_snapshot(self.query())
+      else:
+        updated = self.query(where=":updated_at >= '%s'" % last_update)
+        logging.info('%d records updated since %s' % (
+            len(updated), last_update))
+        if updated:
+          by_id = collections.OrderedDict((r.get(':id'), r) for r in snapshot)
+          for record in updated:
+            by_id[record[':id']] = record
+          self._write_snapshot(by_id.values())
     self._fetched = True
 
+  def _write_snapshot(self, records):
+    tmp_file = tempfile.NamedTemporaryFile(delete=False)
+    tmp_file.write(json.dumps(records, indent=1))
+    tmp_file.close()
+    os.rename(tmp_file.name, self.cache_file)
+
   def records(self):
     if not self._fetched:
       self.fetch()
     return json.load(file(self.cache_file))
-    
-     
+
+
 class LobbyistActivity(SodaEndPoint):
   url = 'https://data.sfgov.org/resource/hr5m-xnxc.json'
 
 
 if __name__ == '__main__':
-  LobbyistActivity().fetch()
+  logging.basicConfig(level='INFO')
+  LobbyistActivity().fetch(refresh=True)
@@ -0,0 +1,301 @@
+#! /usr/bin/python
+"""
+Keeps the scraped data and the reports built from it up to date.
+
+The pipeline is modelled as a graph of nodes: legistar vote years and SODA
+datasets are sources, which are refreshed on a per-source schedule, and the
+reports in ./data are built from them.  Each node remembers fingerprints of
+its inputs and outputs in a state file, so a node is only run when it's
+overdue, its outputs have gone missing, or something upstream of it has
+actually changed.  Nodes which don't depend on each other run in parallel,
+except where they share a resource (e.g. the sqlite database).
+
+Run it from cron, or with --daemon to keep it running.
+"""
+import argparse
+import datetime
+import fcntl
+import glob
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+STATE_FILE = './sync-state.json'
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+
+class Node(object):
+  """A step in the pipeline.
+
+  Attributes:
+    name, string, unique name of the node.
+    command, list of strings, the command line to run to (re)build the node.
+    outputs, list of strings, glob patterns for the files the node produces.
+    sources, list of strings, glob patterns for files the node reads which
+      aren't produced by another node (scripts, payloads, ...).
+    deps, list of strings, names of the nodes this node is built from.
+    interval, int, if set, rebuild the node when it's older than this many
+      seconds, even if nothing upstream has changed.
+    refresh_command, list of strings, if set, used instead of command when
+      the node is rebuilt because its interval has elapsed.
+    resource, string, nodes sharing a resource never run at the same time.
+  """
+
+  def __init__(self, name, command, outputs, sources=(), deps=(),
+               interval=None, refresh_command=None, resource=None):
+    self.name = name
+    self.command = command
+    self.outputs = list(outputs)
+    self.sources = list(sources)
+    self.deps = list(deps)
+    self.interval = interval
+    self.refresh_command = refresh_command
+    self.resource = resource
+
+
+def fingerprint(patterns):
+  """Cheaply fingerprint the files matching some glob patterns.
+
+  Uses the paths, sizes and modification times rather than the contents,
+  so that checking a large cache is quick.
+
+  Returns:
+    string, a hex digest, or None if no files match.
+  """
+  paths = sorted(set(p for pattern in patterns for p in glob.glob(pattern)))
+  if not paths:
+    return None
+  digest = hashlib.sha1()
+  for path in paths:
+    stat = os.stat(path)
+    digest.update('%s:%d:%d\n' % (path, stat.st_size, int(stat.st_mtime)))
+  return digest.hexdigest()
+
+
+def pipeline(first_year, last_year):
+  """Build the graph of nodes for the given range of legistar years."""
+  python = sys.executable
+  this_year = datetime.date.today().year
+
+  nodes = []
+  for year in range(first_year, last_year + 1):
+    nodes.append(Node(
+        'legistar-%d' % year,
+        [python, 'collect.py', str(year), str(year)],
+        outputs=['./cache/vote-listings-%d-*.html' % year],
+        sources=['collect.py', 'db.py', 'payload-*.json'],
+        # past years don't change, so only the current one is re-fetched.
+        # (collect.py replaces a year's votes, so rebuilding is safe.)
+        interval=DAY if year == this_year else None,
+        refresh_command=[python, 'collect.py', '--refresh',
+                         str(year), str(year)],
+        resource='vote_db'))
+
+  nodes.append(Node(
+      'soda-LobbyistActivity',
+      [python, 'sfdata.py'],
+      outputs=['LobbyistActivity.json'],
+      sources=['sfdata.py'],
+      interval=HOUR))
+
+  nodes.append(Node(
+      'reports',
+      [python, 'lobby-record.py'],
+      outputs=['data/Timeline.json', 'data/*.csv',
+               'data/*/*.json', 'data/*/*.csv'],
+      sources=['lobby-record.py', 'db.py', 'sfdata.py'],
+      deps=[node.name for node in nodes],
+      # the reports cover a window ending today, so they age by themselves.
+      interval=DAY,
+      resource='vote_db'))
+  return nodes
+
+
+class Scheduler(object):
+  """Runs the stale nodes of a pipeline, recording state between runs."""
+
+  def __init__(self, nodes, state_file=STATE_FILE):
+    self._nodes = dict((node.name, node) for node in nodes)
+    self._state_file = state_file
+    self._locks = {}
+    self._load_state()
+
+  def levels(self):
+    """Group the nodes into lists which only depend on earlier lists."""
+    done = set()
+    levels = []
+    while len(done) < len(self._nodes):
+      level = [node for node in self._nodes.values() if node.name not in done
+               and all(dep in done for dep in node.deps)]
+      if not level:
+        raise ValueError('Dependency cycle among %s' % (
+            sorted(set(self._nodes) - done)))
+      levels.append(sorted(level, key=lambda node: node.name))
+      done.update(node.name for node in level)
+    return levels
+
+  def input_fingerprint(self, node):
+    """Fingerprint of everything a node is built from."""
+    digest = hashlib.sha1()
+    digest.update(' '.join(node.command))
+    digest.update(str(fingerprint(node.sources)))
+    for dep in sorted(node.deps):
+      digest.update('%s=%s' % (dep, self._state.get(dep, {}).get('outputs')))
+    return digest.hexdigest()
+
+  def why_stale(self, node, now):
+    """Returns the reason a node needs to be rebuilt, or None."""
+    state = self._state.get(node.name)
+    if not state:
+      return 'never built'
+    if fingerprint(node.outputs) != state.get('outputs'):
+      return 'outputs missing or modified'
+    if self.input_fingerprint(node) != state.get('inputs'):
+      return 'inputs changed'
+    if node.interval and now - state.get('built', 0) >= node.interval:
+      return 'scheduled refresh'
+    return None
+
+  def build(self, node, reason):
+    """Run a node's command, and record its fingerprints if it succeeds."""
+    command = node.command
+    if reason == 'scheduled refresh' and node.refresh_command:
+      command = node.refresh_command
+    lock = self._locks.get(node.resource)
+    if lock:
+      lock.acquire()
+    try:
+      logging.info('building %s (%s): %s' % (
+          node.name, reason, ' '.join(command)))
+      started = time.time()
+      status = subprocess.call(command)
+    finally:
+      if lock:
+        lock.release()
+    if status != 0:
+      logging.error('%s failed with status %d' % (node.name, status))
+      return False
+    logging.info('built %s in %.1fs' % (node.name, time.time() - started))
+    self._state[node.name] = {
+        'built': started,
+        'inputs': self.input_fingerprint(node),
+        'outputs': fingerprint(node.outputs),
+    }
+    return True
+
+  def run_once(self):
+    """Brings every node up to date.
+
+    Callers should hold the lock(), so overlapping runs don't build the same
+    nodes or clobber each other's state.  Nodes downstream of a failed build
+    are skipped until the next run.
+
+    Returns:
+      bool, True if nothing failed.
+    """
+    # another run may have updated the state since it was last read.
+    self._load_state()
+    now = time.time()
+    failed = set()
+    for node in self._nodes.values():
+      if node.resource and node.resource not in self._locks:
+        self._locks[node.resource] = threading.Lock()
+
+    for level in self.levels():
+      results = {}
+      threads = []
+      for node in level:
+        if any(dep in failed for dep in node.deps):
+          logging.warn('skipping %s, a dependency failed' % node.name)
+          failed.add(node.name)
+          continue
+        reason = self.why_stale(node, now)
+        if not reason:
+          continue
+
+        def build(node=node, reason=reason):
+          try:
+            results[node.name] = self.build(node, reason)
+          except Exception:
+            logging.exception('%s failed' % node.name)
+            results[node.name] = False
+        thread = threading.Thread(target=build, name=node.name)
+        thread.start()
+        threads.append(thread)
+      for thread in threads:
+        thread.join()
+      failed.update(name for (name, ok) in results.items() if not ok)
+      self._save_state()
+    return not failed
+
+  def lock(self):
+    """Takes an exclusive lock on the state file, without waiting.
+
+    Returns:
+      The open lock file, which holds the lock until it's closed, or None
+      if another run holds the lock.
+    """
+    lock_file = open('%s.lock' % self._state_file, 'a')
+    try:
+      fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+      lock_file.close()
+      return None
+    return lock_file
+
+  def _load_state(self):
+    try:
+      self._state = json.load(file(self._state_file))
+    except (IOError, ValueError):
+      self._state = {}
+
+  def _save_state(self):
+    tmp_file = tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(os.path.abspath(self._state_file)), delete=False)
+    tmp_file.write(json.dumps(self._state, indent=1, sort_keys=True))
+    tmp_file.close()
+    os.rename(tmp_file.name, self._state_file)
+
+
+##
+## Main script
+##
+if __name__ == '__main__':
+  logging.basicConfig(level='INFO')
+  parser = argparse.ArgumentParser(description=
+      '''
+      Refresh the legistar and datasf sources on their schedules, and rebuild
+      whichever reports are out of date.
+      '''
+  )
+  parser.add_argument('first_year', metavar='first year', type=int)
+  parser.add_argument('last_year', metavar='last year', type=int,
+                      nargs='?', default=datetime.date.today().year)
+  parser.add_argument('--daemon', action='store_true',
+                      help='keep running, checking for work periodically')
+  parser.add_argument('--poll', type=int, default=300,
+                      help='seconds between checks in daemon mode')
+  args = parser.parse_args()
+
+  scheduler = Scheduler(pipeline(args.first_year, args.last_year))
+  while True:
+    lock = scheduler.lock()
+    if not lock:
+      logging.info('another sync is already running')
+      ok = True
+    else:
+      try:
+        ok = scheduler.run_once()
+      finally:
+        lock.close()
+    if not args.daemon:
+      sys.exit(0 if ok else 1)
+    time.sleep(args.poll)
@@ -0,0 +1,59 @@
+#! /usr/bin/python
+"""
+Checks for the join-ready queries in db.py, run against a small in-memory
+database:
+
+    python -m unittest test_db
+"""
+import datetime
+import unittest
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import db
+
+
+class LobbyingQueriesTest(unittest.TestCase):
+
+  def setUp(self):
+    engine = create_engine('sqlite://')
+    db.Base.metadata.create_all(engine)
+    self.session = sessionmaker(bind=engine)()
+
+    # two proposals, both voted on by one supervisor, only the first by the
+    # other, and lobbied about before and after their votes.
+    self.alice = db.Legislator('Alice')
+    self.bob = db.Legislator('Bob')
+    parks = db.Proposal(100, 'Parks')
+    housing = db.Proposal(200, 'Housing')
+    self.parks_vote = db.VoteEvent(parks, datetime.date(2014, 5, 1))
+    self.housing_vote = db.VoteEvent(housing, datetime.date(2014, 6, 1))
+    self.session.add_all([
+        db.Vote(self.alice, self.parks_vote, True),
+        db.Vote(self.bob, self.parks_vote, False),
+        db.Vote(self.alice, self.housing_vote, True),
+        db.LobbyingReference('row-1', 100, datetime.date(2014, 4, 1)),
+        db.LobbyingReference('row-2', 100, datetime.date(2014, 4, 15)),
+        db.LobbyingReference('row-3', 100, datetime.date(2014, 7, 1)),
+        db.LobbyingReference('row-4', 200, datetime.date(2014, 5, 15)),
+        # cites a file that was never scraped.
+        db.LobbyingReference('row-5', 300, datetime.date(2014, 5, 15)),
+    ])
+    self.session.commit()
+
+  def test_lobbying_for_legislator(self):
+    def contacts(legislator):
+      return sorted(reference.soda_id for (reference, _) in
+                    db.lobbying_for_legislator(self.session, legislator))
+    self.assertEqual(contacts(self.alice),
+                     ['row-1', 'row-2', 'row-3', 'row-4'])
+    self.assertEqual(contacts(self.bob), ['row-1', 'row-2', 'row-3'])
+
+  def test_lobbying_before_vote_events(self):
+    counts = dict(db.lobbying_before_vote_events(self.session))
+    self.assertEqual(counts, {self.parks_vote: 2, self.housing_vote: 1})
+
+
+if __name__ == '__main__':
+  unittest.main()